@@ -2,62 +2,407 @@
 
 
 # +
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import streamlit as st
 import pandas as pd
 import numpy as np
-from shapely.geometry import Point, Polygon
+import shapely
+from shapely.geometry import Polygon
+from shapely.strtree import STRtree
 from PIL import Image, ImageDraw
-from collections import defaultdict
 import matplotlib.pyplot as plt
 
+# タッチ列の並び（元の coord_df の列順: like1, dislike1, like2, dislike2）
+TOUCH_COLUMNS = [(kind, i) for i in range(1, 3) for kind in ("like", "dislike")]
+LIKE_COLS = [c for c, (kind, _) in enumerate(TOUCH_COLUMNS) if kind == "like"]
+DISLIKE_COLS = [c for c, (kind, _) in enumerate(TOUCH_COLUMNS) if kind == "dislike"]
+
 # -----------------------------
-# 🔧 1. 集計関数（ルール前後 & 座標出力対応）
+# 📍 タッチ座標の配列化
 # -----------------------------
-def calculate_area_flags(resp_df, polygons, apply_rule=True):
-    total_ids = len(resp_df)
+def get_respondent_ids(resp_df):
+    if isinstance(resp_df, TouchStore):
+        return resp_df.rid_values[resp_df.rid_codes]
+    if "Respondent ID" in resp_df.columns:
+        return resp_df["Respondent ID"].to_numpy()
+    return resp_df.index.to_numpy()
+
+def get_respondent_codes(resp_df):
+    # 回答者IDの通し番号（同じIDは同じ番号）と、行ごとの回答者ID
+    if isinstance(resp_df, TouchStore):
+        return resp_df.rid_codes, get_respondent_ids(resp_df)
+    rids = get_respondent_ids(resp_df)
+    rid_codes, _ = pd.factorize(rids, use_na_sentinel=False)
+    return rid_codes, rids
+
+def get_touch_matrix(resp_df):
+    # 回答者数 × 4 タッチの x, y 配列（列が無い場合は NaN）
+    if isinstance(resp_df, TouchStore):
+        return resp_df.xs, resp_df.ys
+    n = len(resp_df)
+    xs = np.full((n, len(TOUCH_COLUMNS)), np.nan)
+    ys = np.full((n, len(TOUCH_COLUMNS)), np.nan)
+    for c, (kind, i) in enumerate(TOUCH_COLUMNS):
+        if f"{kind}{i}_x" in resp_df.columns and f"{kind}{i}_y" in resp_df.columns:
+            xs[:, c] = resp_df[f"{kind}{i}_x"].to_numpy(dtype=float)
+            ys[:, c] = resp_df[f"{kind}{i}_y"].to_numpy(dtype=float)
+    return xs, ys
 
-    # 各回答者 × エリアのlike/dislike集計
-    per_respondent_area = defaultdict(lambda: defaultdict(lambda: {"like": 0, "dislike": 0}))
-    area_flags = {area: {"like": 0, "dislike": 0} for area in polygons}
-
-    for idx, row in resp_df.iterrows():
-        rid = row.get("Respondent ID", idx)
-        for i in range(1, 3):
-            lx, ly = row.get(f"like{i}_x"), row.get(f"like{i}_y")
-            dx, dy = row.get(f"dislike{i}_x"), row.get(f"dislike{i}_y")
-            if pd.notnull(lx) and pd.notnull(ly):
-                for area_name, poly in polygons.items():
-                    if poly.contains(Point(lx, ly)):
-                        per_respondent_area[rid][area_name]["like"] += 1
-                        break
-            if pd.notnull(dx) and pd.notnull(dy):
-                for area_name, poly in polygons.items():
-                    if poly.contains(Point(dx, dy)):
-                        per_respondent_area[rid][area_name]["dislike"] += 1
-                        break
-
-    for rid, area_data in per_respondent_area.items():
-        for area, counts in area_data.items():
-            like = counts["like"]
-            dislike = counts["dislike"]
-            if apply_rule:
-                if like > 0 and dislike > 0:
-                    continue
-                elif like > 0:
-                    area_flags[area]["like"] += like
-                elif dislike > 0:
-                    area_flags[area]["dislike"] += dislike
-            else:
-                area_flags[area]["like"] += like
-                area_flags[area]["dislike"] += dislike
+# -----------------------------
+# 💾 タッチ座標のバイナリストア（メモリマップ）
+# -----------------------------
+TOUCH_STORE_VERSION = 1
+TOUCH_STORE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "xy_plot_ui", "touch_store")
+
+class TouchStore:
+    # 列指向のタッチ座標（x, y）と回答者ID番号。メモリ上の配列でも、メモリマップしたバイナリでもよい
+    def __init__(self, xs, ys, rid_codes, rid_values):
+        self.xs = xs
+        self.ys = ys
+        self.rid_codes = rid_codes
+        self.rid_values = rid_values
+
+    def __len__(self):
+        return len(self.rid_codes)
+
+def to_touch_store(resp_df):
+    # DataFrame を一度だけ配列化し、何度も集計に使えるようにする
+    if isinstance(resp_df, TouchStore):
+        return resp_df
+    xs, ys = get_touch_matrix(resp_df)
+    rid_codes, rid_values = pd.factorize(get_respondent_ids(resp_df), use_na_sentinel=False)
+    return TouchStore(xs, ys, rid_codes.astype(np.int64), np.asarray(rid_values))
+
+def open_touch_store(path):
+    # import_touch_store で作ったバイナリをメモリマップで開く（ページはプロセス間で共有される）
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta["version"] != TOUCH_STORE_VERSION:
+        raise ValueError(f"未対応のタッチストアです（version={meta['version']}）")
+    shape = (meta["rows"], len(TOUCH_COLUMNS))
+    rid_values = np.load(os.path.join(path, "rid_values.npy"), allow_pickle=False)
+    if meta["rows"] == 0:
+        # 空のファイルはメモリマップできないので、空の配列を返す
+        return TouchStore(np.empty(shape), np.empty(shape), np.empty(0, dtype=np.int64), rid_values)
+    return TouchStore(
+        np.memmap(os.path.join(path, "x.f8"), dtype=np.float64, mode="r", shape=shape),
+        np.memmap(os.path.join(path, "y.f8"), dtype=np.float64, mode="r", shape=shape),
+        np.memmap(os.path.join(path, "rid_codes.i8"), dtype=np.int64, mode="r", shape=(meta["rows"],)),
+        rid_values,
+    )
+
+def import_touch_store(csv_file, path, chunksize=500_000):
+    # CSV をチャンクごとに読み、座標と回答者ID番号をバイナリに追記する（全件をメモリに載せない）
+    # 同じプロセス内の別セッションが同時に取り込んでも衝突しないよう、一時フォルダは毎回別の名前にする
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path) or ".")
+    # 途中で読み込みに失敗したら（壊れた CSV など）、書きかけの一時フォルダを残さない
+    try:
+        known_ids = pd.Index([])
+        rows = 0
+        with open(os.path.join(tmp_path, "x.f8"), "wb") as fx, \
+             open(os.path.join(tmp_path, "y.f8"), "wb") as fy, \
+             open(os.path.join(tmp_path, "rid_codes.i8"), "wb") as fr:
+            for chunk in pd.read_csv(csv_file, chunksize=chunksize):
+                xs, ys = get_touch_matrix(chunk)
+                rids = get_respondent_ids(chunk)
+                codes = known_ids.get_indexer(rids)
+                if (codes < 0).any():
+                    known_ids = known_ids.append(pd.Index(pd.unique(rids[codes < 0])))
+                    codes = known_ids.get_indexer(rids)
+                xs.astype(np.float64).tofile(fx)
+                ys.astype(np.float64).tofile(fy)
+                codes.astype(np.int64).tofile(fr)
+                rows += len(chunk)
+
+        rid_values = known_ids.to_numpy()
+        if rid_values.dtype == object:
+            rid_values = rid_values.astype(str)
+        np.save(os.path.join(tmp_path, "rid_values.npy"), rid_values, allow_pickle=False)
+        with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": TOUCH_STORE_VERSION, "rows": rows}, f)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    # 書き終えてから置き換えるので、途中のストアを他のセッションやプロセスが開くことはない
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            raise
+    return open_touch_store(path)
+
+def touch_store_for_upload(resp_file):
+    # 同じ内容のファイルは一度だけ取り込み、以降はセッションやプロセスをまたいで再利用する
+    data = resp_file.getvalue()
+    path = os.path.join(TOUCH_STORE_DIR, hashlib.sha1(data).hexdigest())
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return open_touch_store(path)
+    return import_touch_store(io.BytesIO(data), path)
+
+@st.cache_resource(max_entries=4)
+def uploaded_touches(resp_key, _resp_file):
+    # CSV のアップロードを file_id ごとに一度だけ配列化し、再実行のたびに読み直さない
+    # 再実行のたびにスクリプトごと TouchStore クラスが作り直されるので、キャッシュには素の配列だけを入れる
+    touches, _ = read_touch_file(_resp_file)
+    return touches.xs, touches.ys, touches.rid_codes, touches.rid_values
+
+# -----------------------------
+# 📐 端末座標 → 画像座標の正規化（アフィン変換）
+# -----------------------------
+TRANSFORM_DEFAULTS = {"scale_x": 1.0, "scale_y": 1.0, "offset_x": 0.0, "offset_y": 0.0, "rotation": 0.0}
+
+def build_affine_matrices(transforms):
+    # 変換表の各行から 2×3 のアフィン行列を作る（拡大縮小 → 原点まわりの回転（度）→ 平行移動の順）
+    params = {}
+    for col, default in TRANSFORM_DEFAULTS.items():
+        if col in transforms.columns:
+            params[col] = transforms[col].fillna(default).to_numpy(dtype=float)
+        else:
+            params[col] = np.full(len(transforms), default)
+    theta = np.deg2rad(params["rotation"])
+    cos, sin = np.cos(theta), np.sin(theta)
+
+    matrices = np.empty((len(transforms), 2, 3))
+    matrices[:, 0, 0] = cos * params["scale_x"]
+    matrices[:, 0, 1] = -sin * params["scale_y"]
+    matrices[:, 0, 2] = params["offset_x"]
+    matrices[:, 1, 0] = sin * params["scale_x"]
+    matrices[:, 1, 1] = cos * params["scale_y"]
+    matrices[:, 1, 2] = params["offset_y"]
+    return matrices
+
+def normalize_touches(resp_df, row_keys, transforms):
+    # transforms の 1 列目（端末名や回答者ID）で各行の変換を引き、全タッチ列を 1 回の行列演算で画像座標にする
+    # 変換表に無いキーの行はそのまま（恒等変換）。変換後の TouchStore と、変換表に無かった行数を返す
+    touches = to_touch_store(resp_df)
+    transforms = transforms.drop_duplicates(transforms.columns[0], keep="last")
+    identity = np.array([[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]])
+    matrices = np.concatenate([build_affine_matrices(transforms), identity])
+    idx = pd.Index(transforms.iloc[:, 0]).get_indexer(row_keys)
+    per_row = matrices[idx]
+
+    points = np.stack([touches.xs, touches.ys], axis=-1)
+    mapped = np.einsum("nij,nkj->nki", per_row[:, :, :2], points) + per_row[:, None, :, 2]
+    normalized = TouchStore(np.ascontiguousarray(mapped[..., 0]), np.ascontiguousarray(mapped[..., 1]),
+                            touches.rid_codes, touches.rid_values)
+    return normalized, int((idx < 0).sum())
+
+def mapping_row_keys(resp_df, key_col):
+    # 変換表の 1 列目（端末名や回答者ID）に対応する、回答データの行ごとのキー
+    if key_col == "Respondent ID":
+        return get_respondent_ids(resp_df)
+    if isinstance(resp_df, pd.DataFrame) and key_col in resp_df.columns:
+        return resp_df[key_col].to_numpy()
+    raise ValueError(f"回答データに変換表のキー列「{key_col}」がありません")
+
+def read_key_column(resp_file, key_col):
+    # TouchStore には座標と回答者IDしか無いので、端末名などのキー列は元の CSV からその列だけ読む
+    keys = pd.read_csv(io.BytesIO(resp_file.getvalue()), usecols=lambda col: col == key_col)
+    if key_col not in keys.columns:
+        raise ValueError(f"回答データに変換表のキー列「{key_col}」がありません")
+    return keys[key_col].to_numpy()
+
+@st.cache_resource(max_entries=4)
+def normalized_touches(resp_key, mapping_key, _resp_df, _transforms, _resp_file=None):
+    # 正規化した配列をアップロードの組ごとに保持し、再実行や後段の処理で使い回す
+    # 再実行のたびにスクリプトごと TouchStore クラスが作り直されるので、キャッシュには素の配列だけを入れる
+    key_col = _transforms.columns[0]
+    if isinstance(_resp_df, TouchStore) and key_col != "Respondent ID" and _resp_file is not None:
+        row_keys = read_key_column(_resp_file, key_col)
+    else:
+        row_keys = mapping_row_keys(_resp_df, key_col)
+    touches, unmatched = normalize_touches(_resp_df, row_keys, _transforms)
+    return touches.xs, touches.ys, touches.rid_codes, touches.rid_values, unmatched
+
+# -----------------------------
+# 🧩 エリア定義のコンパイル（検証・修復・空間インデックス）
+# -----------------------------
+AREA_ARTIFACT_VERSION = 1
+
+class AreaSet:
+    # エリア名・修復済みポリゴン（prepared）・外接矩形・STRtree をまとめたもの
+    def __init__(self, names, geoms, issues=None):
+        self.names = [str(name) for name in names]
+        self.geoms = np.asarray(list(geoms), dtype=object)
+        shapely.prepare(self.geoms)
+        self.bounds = shapely.bounds(self.geoms).reshape(len(self.geoms), 4)
+        self.tree = STRtree(self.geoms)
+        self.issues = list(issues or [])
+
+    def __len__(self):
+        return len(self.names)
+
+def as_area_set(polygons):
+    # 従来の {エリア名: Polygon} の dict もそのまま受け付ける
+    if isinstance(polygons, AreaSet):
+        return polygons
+    return AreaSet(polygons.keys(), polygons.values())
+
+def repair_polygon(poly):
+    # 自己交差などの不正なポリゴンを修復し、面の部分だけを残す
+    fixed = shapely.make_valid(poly)
+    if fixed.geom_type in ("Polygon", "MultiPolygon"):
+        return fixed
+    parts = [g for g in getattr(fixed, "geoms", []) if g.geom_type in ("Polygon", "MultiPolygon")]
+    return shapely.union_all(parts) if parts else None
+
+def compile_areas(area_df):
+    # area.csv（name, x, y, 任意で order 列）からエリアセットを作る
+    # order 列があれば頂点順はそれに従い、無ければファイル上の行順をそのまま使う
+    names, geoms, issues = [], [], []
+    for name, group in area_df.groupby("name"):
+        if "order" in group.columns:
+            group = group.sort_values("order", kind="stable")
+        vertices = group[["x", "y"]].dropna()
+        if len(vertices) < len(group):
+            issues.append(f"{name}: 座標が欠けている頂点を {len(group) - len(vertices)} 件除外しました")
+        if len(vertices) < 3:
+            issues.append(f"{name}: 頂点が 3 点未満のため除外しました")
+            continue
+
+        poly = Polygon(vertices.to_numpy(dtype=float))
+        if not poly.is_valid:
+            reason = shapely.is_valid_reason(poly)
+            poly = repair_polygon(poly)
+            if poly is None or poly.is_empty:
+                issues.append(f"{name}: 不正なポリゴン（{reason}）を修復できないため除外しました")
+                continue
+            issues.append(f"{name}: 不正なポリゴン（{reason}）を修復しました")
+
+        names.append(name)
+        geoms.append(poly)
+    return AreaSet(names, geoms, issues)
+
+def save_area_set(area_set, file):
+    # WKB を連結した 1 つのバイナリ（非圧縮 npz）に保存する（外接矩形は読み込み時に AreaSet が計算し直す）
+    wkb = shapely.to_wkb(area_set.geoms)
+    offsets = np.cumsum([0] + [len(b) for b in wkb]).astype(np.int64)
+    np.savez(
+        file,
+        version=np.array(AREA_ARTIFACT_VERSION),
+        names=np.array(area_set.names, dtype=str),
+        wkb=np.frombuffer(b"".join(wkb), dtype=np.uint8),
+        offsets=offsets,
+        issues=np.array(area_set.issues, dtype=str),
+    )
+
+def load_area_set(file):
+    with np.load(file, allow_pickle=False) as data:
+        if int(data["version"]) != AREA_ARTIFACT_VERSION:
+            raise ValueError(f"未対応のエリア定義ファイルです（version={int(data['version'])}）")
+        buf = data["wkb"].tobytes()
+        offsets = data["offsets"]
+        wkb = [buf[offsets[k]:offsets[k + 1]] for k in range(len(offsets) - 1)]
+        return AreaSet(data["names"].tolist(), shapely.from_wkb(wkb), data["issues"].tolist())
+
+def read_area_file(area_file):
+    # アップロードされた area.csv（コンパイルする）またはコンパイル済み .npz を読む
+    if area_file.name.endswith(".npz"):
+        return load_area_set(area_file)
+    return compile_areas(pd.read_csv(area_file))
 
+# -----------------------------
+# 🗺️ タッチ → エリア判定（空間インデックス）
+# -----------------------------
+def find_touch_areas(xs, ys, polygons, tolerance=None):
+    # タッチ × エリアの所属行列を (タッチ番号, エリア番号) の組（疎行列）で返す
+    # あわせて許容距離で最寄りエリアに再割当されたタッチのフラグも返す
+    tree = as_area_set(polygons).tree
+    reassigned = np.zeros(len(xs), dtype=bool)
+    valid_pos = np.flatnonzero(~(np.isnan(xs) | np.isnan(ys)))
+    if len(tree) == 0 or len(valid_pos) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, reassigned
+
+    points = shapely.points(xs[valid_pos], ys[valid_pos])
+    pt, ar = tree.query(points, predicate="within")
+
+    # エリア外のタッチは許容距離内の最寄りエリアへ（等距離なら先頭側のエリア 1 つ）
+    if tolerance:
+        miss = np.flatnonzero(~np.isin(np.arange(len(points)), pt))
+        if len(miss):
+            near_pt, near_ar = tree.query_nearest(points[miss], max_distance=tolerance)
+            order = np.lexsort((near_ar, near_pt))
+            _, first = np.unique(near_pt[order], return_index=True)
+            near_pt, near_ar = miss[near_pt[order][first]], near_ar[order][first]
+            reassigned[valid_pos[near_pt]] = True
+            pt = np.concatenate([pt, near_pt])
+            ar = np.concatenate([ar, near_ar])
+
+    return valid_pos[pt], ar.astype(np.int64), reassigned
+
+def first_touch_areas(touch, area):
+    # 重なっている場合は polygons の先頭側のエリアだけ残す（従来の break と同じ）
+    order = np.lexsort((area, touch))
+    touch, area = touch[order], area[order]
+    _, first = np.unique(touch, return_index=True)
+    return touch[first], area[first]
+
+def classify_touches(xs, ys, polygons, tolerance=None):
+    # 各タッチのエリア番号（polygons の順、該当なしは -1）と、再割当フラグを返す
+    touch, area, reassigned = find_touch_areas(xs, ys, polygons, tolerance)
+    touch, area = first_touch_areas(touch, area)
+    area_idx = np.full(len(xs), -1, dtype=np.int64)
+    area_idx[touch] = area
+    return area_idx, reassigned
+
+# -----------------------------
+# 🔧 1. 集計関数（ルール前後 & 座標出力対応）
+# -----------------------------
+def count_respondent_areas(rid_keys, is_like):
+    # 回答者ID × エリア番号のキーごとに like / dislike の数をまとめる
+    keys, inverse = np.unique(rid_keys, return_inverse=True)
+    like_counts = np.bincount(inverse[is_like], minlength=len(keys))
+    dislike_counts = np.bincount(inverse[~is_like], minlength=len(keys))
+    return keys, like_counts, dislike_counts
+
+def merge_respondent_areas(parts):
+    # バッチごとの集計をまとめる（同じ回答者が複数バッチにまたがっていても合算される）
+    if len(parts) == 1:
+        return parts[0]
+    if not parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    keys, inverse = np.unique(np.concatenate([p[0] for p in parts]), return_inverse=True)
+    like_counts = np.bincount(inverse, weights=np.concatenate([p[1] for p in parts]), minlength=len(keys))
+    dislike_counts = np.bincount(inverse, weights=np.concatenate([p[2] for p in parts]), minlength=len(keys))
+    return keys, like_counts.astype(np.int64), dislike_counts.astype(np.int64)
+
+def cancel_like_dislike(like_counts, dislike_counts):
+    # 同じ回答者が同じエリアに like と dislike を付けていたら相殺
+    keep = ~((like_counts > 0) & (dislike_counts > 0))
+    return like_counts * keep, dislike_counts * keep
+
+def sum_area_flags(keys, like_counts, dislike_counts, n_areas, apply_rule):
+    if apply_rule:
+        like_counts, dislike_counts = cancel_like_dislike(like_counts, dislike_counts)
+    key_area = keys % n_areas
+    area_like = np.bincount(key_area, weights=like_counts, minlength=n_areas)
+    area_dislike = np.bincount(key_area, weights=dislike_counts, minlength=n_areas)
+    return area_like, area_dislike
+
+def summarize_area_flags(areas, area_like, area_dislike, total_ids, area_reassigned=None):
     area_summary = []
-    for area, counts in area_flags.items():
-        like = counts["like"]
-        dislike = counts["dislike"]
+    for a, area_name in enumerate(areas):
+        like = int(area_like[a])
+        dislike = int(area_dislike[a])
         none = total_ids - like - dislike
-        area_summary.append({
-            "area": area,
+        summary = {
+            "area": area_name,
             "like": like,
             "dislike": dislike,
             "none": none,
@@ -65,118 +410,597 @@ def calculate_area_flags(resp_df, polygons, apply_rule=True):
             "like_ratio": like / total_ids if total_ids else 0,
             "dislike_ratio": dislike / total_ids if total_ids else 0,
             "none_ratio": none / total_ids if total_ids else 0
-        })
-
-    area_df = pd.DataFrame(area_summary)
-
-    # XY抽出（ルール適用後のみ）
-    coord_rows = []
-    for idx, row in resp_df.iterrows():
-        rid = row.get("Respondent ID", idx)
-        like_areas = {}
-        dislike_areas = {}
-
-        for i in range(1, 3):
-            lx, ly = row.get(f"like{i}_x"), row.get(f"like{i}_y")
-            dx, dy = row.get(f"dislike{i}_x"), row.get(f"dislike{i}_y")
-
-            if pd.notnull(lx) and pd.notnull(ly):
-                for area, poly in polygons.items():
-                    if poly.contains(Point(lx, ly)):
-                        like_areas[i] = area
-                        break
-            if pd.notnull(dx) and pd.notnull(dy):
-                for area, poly in polygons.items():
-                    if poly.contains(Point(dx, dy)):
-                        dislike_areas[i] = area
-                        break
-
-        canceled_areas = set(like_areas.values()) & set(dislike_areas.values())
-
-        row_dict = {"Respondent ID": rid}
-        for i in range(1, 3):
-            if i in like_areas and like_areas[i] not in canceled_areas:
-                row_dict[f"like{i}_x"] = row.get(f"like{i}_x")
-                row_dict[f"like{i}_y"] = row.get(f"like{i}_y")
-            else:
-                row_dict[f"like{i}_x"] = np.nan
-                row_dict[f"like{i}_y"] = np.nan
-
-            if i in dislike_areas and dislike_areas[i] not in canceled_areas:
-                row_dict[f"dislike{i}_x"] = row.get(f"dislike{i}_x")
-                row_dict[f"dislike{i}_y"] = row.get(f"dislike{i}_y")
-            else:
-                row_dict[f"dislike{i}_x"] = np.nan
-                row_dict[f"dislike{i}_y"] = np.nan
+        }
+        if area_reassigned is not None:
+            summary["reassigned"] = int(area_reassigned[a])
+        area_summary.append(summary)
+    return pd.DataFrame(area_summary)
+
+def iter_area_flags(resp_df, polygons, apply_rule=True, tolerance=None, multi=False, batch_size=None):
+    # 回答者を batch_size 行ずつ集計し、(進捗, (area_df, coord_df)) を順に yield する
+    # 途中の area_df は処理済みの回答者だけの集計で、coord_df は最後にだけ返す
+    total_ids = len(resp_df)
+    area_set = as_area_set(polygons)
+    areas = area_set.names
+    n_areas = max(len(areas), 1)
+    n_cols = len(TOUCH_COLUMNS)
+    batch_size = batch_size or max(total_ids, 1)
+
+    rid_codes, rids = get_respondent_codes(resp_df)
+    xs, ys = get_touch_matrix(resp_df)
+    valid = np.zeros(xs.shape, dtype=bool)
+    valid_flat = valid.reshape(-1)
+    parts = []
+    area_reassigned = np.zeros(n_areas, dtype=np.int64)
+    partial_like = np.zeros(n_areas)
+    partial_dislike = np.zeros(n_areas)
+
+    for start in range(0, total_ids, batch_size):
+        end = min(start + batch_size, total_ids)
+        touch, area, reassigned = find_touch_areas(np.ravel(xs[start:end]), np.ravel(ys[start:end]),
+                                                   area_set, tolerance)
+        if not multi:
+            touch, area = first_touch_areas(touch, area)
+        row = touch // n_cols
+        is_like = np.isin(touch % n_cols, LIKE_COLS)
+        area_reassigned += np.bincount(area[reassigned[touch]], minlength=n_areas)
+
+        # 各回答者 × エリアのlike/dislike集計（回答者ID × エリア番号をキーにまとめる）
+        part = count_respondent_areas(rid_codes[start + row].astype(np.int64) * n_areas + area, is_like)
+        parts.append(part)
+
+        # XY抽出（ルール適用後のみ）
+        # 同じ行で like と dislike が同じエリアに当たった組は相殺し、相殺されずに残るエリアがあるタッチだけ表示
+        row_keys = row * n_areas + area
+        canceled = np.where(is_like,
+                            np.isin(row_keys, row_keys[~is_like]),
+                            np.isin(row_keys, row_keys[is_like]))
+        valid_flat[start * n_cols + touch[~canceled]] = True
+
+        if end < total_ids:
+            like, dislike = sum_area_flags(*part, n_areas, apply_rule)
+            partial_like += like
+            partial_dislike += dislike
+            partial_df = summarize_area_flags(areas, partial_like, partial_dislike, end,
+                                              area_reassigned if tolerance else None)
+            yield end / total_ids, (partial_df, None)
+
+    keys, like_counts, dislike_counts = merge_respondent_areas(parts)
+    area_like, area_dislike = sum_area_flags(keys, like_counts, dislike_counts, n_areas, apply_rule)
+    area_df = summarize_area_flags(areas, area_like, area_dislike, total_ids,
+                                   area_reassigned if tolerance else None)
+
+    coord_df = pd.DataFrame({"Respondent ID": rids})
+    for c, (kind, i) in enumerate(TOUCH_COLUMNS):
+        coord_df[f"{kind}{i}_x"] = np.where(valid[:, c], xs[:, c], np.nan)
+        coord_df[f"{kind}{i}_y"] = np.where(valid[:, c], ys[:, c], np.nan)
+
+    yield 1.0, (area_df, coord_df)
+
+def calculate_area_flags(resp_df, polygons, apply_rule=True, tolerance=None, multi=False):
+    for _, result in iter_area_flags(resp_df, polygons, apply_rule, tolerance, multi):
+        pass
+    return result
 
-        coord_rows.append(row_dict)
+# -----------------------------
+# 🔭 プログレッシブ集計（サンプルで概算 → 正確な集計）
+# -----------------------------
+PROGRESSIVE_SAMPLE_SIZES = (1_000, 10_000, 100_000)
+
+def take_touch_rows(resp_df, rows):
+    # 指定した行だけの小さな回答データ（TouchStore は必要な行だけ読み出す）
+    if not isinstance(resp_df, TouchStore):
+        return resp_df.iloc[rows]
+    xs, ys = resp_df.xs[rows], resp_df.ys[rows]
+    sample_df = pd.DataFrame({"Respondent ID": resp_df.rid_values[resp_df.rid_codes[rows]]})
+    for c, (kind, i) in enumerate(TOUCH_COLUMNS):
+        sample_df[f"{kind}{i}_x"] = xs[:, c]
+        sample_df[f"{kind}{i}_y"] = ys[:, c]
+    return sample_df
+
+def draw_sample_rows(rid_codes, size, rng, segments=None):
+    # 回答者単位の無作為抽出（segments があればセグメントごとに抽出する層別抽出）
+    # 同じ回答者の行はまとめて選ぶので、相殺ルールはサンプル内でも全体と同じように働く
+    # 抽出した行・回答者番号・その層と、層ごとの回答者数（母集団）を返す
+    n_respondents = int(rid_codes.max()) + 1 if len(rid_codes) else 0
+    size = min(size, n_respondents)
+    if segments is None:
+        chosen = rng.choice(n_respondents, size, replace=False)
+        chosen_strata = np.zeros(len(chosen), dtype=np.int64)
+        stratum_sizes = np.array([n_respondents])
+    else:
+        first = np.unique(rid_codes, return_index=True)[1]
+        codes, _ = pd.factorize(np.asarray(segments)[first], use_na_sentinel=False)
+        stratum_sizes = np.bincount(codes)
+        order = np.argsort(codes, kind="stable")
+        groups = np.split(order, np.cumsum(stratum_sizes)[:-1])
+        # 小さな層も最低 1 人は選ぶ（偏りは estimate_area_flags の層の重みで補正する）
+        picks = [rng.choice(g, min(len(g), max(1, round(len(g) * size / n_respondents))), replace=False)
+                 for g in groups]
+        chosen = np.concatenate(picks)
+        chosen_strata = np.repeat(np.arange(len(picks)), [len(p) for p in picks])
+    picked = np.zeros(n_respondents, dtype=bool)
+    picked[chosen] = True
+    return np.flatnonzero(picked[rid_codes]), chosen, chosen_strata, stratum_sizes
+
+def respondent_area_counts(resp_df, polygons, apply_rule=True, tolerance=None, multi=False):
+    # 回答者番号（get_respondent_codes）× エリア番号ごとの like / dislike 数（0 件の組は含まない）
+    area_set = as_area_set(polygons)
+    n_areas = max(len(area_set), 1)
+    n_cols = len(TOUCH_COLUMNS)
+    rid_codes, _ = get_respondent_codes(resp_df)
+    xs, ys = get_touch_matrix(resp_df)
+    touch, area, _ = find_touch_areas(np.ravel(xs), np.ravel(ys), area_set, tolerance)
+    if not multi:
+        touch, area = first_touch_areas(touch, area)
+    keys, like_counts, dislike_counts = count_respondent_areas(
+        rid_codes[touch // n_cols].astype(np.int64) * n_areas + area, np.isin(touch % n_cols, LIKE_COLS))
+    if apply_rule:
+        like_counts, dislike_counts = cancel_like_dislike(like_counts, dislike_counts)
+    return keys // n_areas, keys % n_areas, like_counts, dislike_counts
+
+def stratified_totals(s1, s2, n_h, N_h):
+    # 層 × エリアごとの回答者の件数の合計 s1・二乗和 s2 から、母集団の合計の推定値と分散を求める
+    n = n_h[:, None].astype(float)
+    N = N_h[:, None].astype(float)
+    mean = s1 / n
+    var_h = np.where(n > 1, (s2 - n * mean ** 2) / np.maximum(n - 1, 1), 0.0)
+    total = (N * mean).sum(axis=0)
+    variance = (N ** 2 * (1 - n / N) * np.maximum(var_h, 0.0) / n).sum(axis=0)
+    return total, variance
+
+def estimate_area_flags(sample_df, counts, resp_strata, resp_rows, stratum_sizes, total_ids, z=1.96):
+    # 回答者ごとの件数を層の重み N_h / n_h で引き伸ばして全体の件数を推定し、
+    # 割合の誤差幅（回答者ごとの件数の分散から、有限母集団修正つき・約95%）を付ける
+    resp, area, like_counts, dislike_counts = counts
+    n_areas = max(len(sample_df), 1)
+    n_strata = len(stratum_sizes)
+    n_h = np.bincount(resp_strata, minlength=n_strata)
+    cell = resp_strata[resp] * n_areas + area
+
+    def by_cell(weights):
+        return np.bincount(cell, weights=weights, minlength=n_strata * n_areas).reshape(n_strata, n_areas)
+
+    # none は既知の総数から like + dislike を引いたものなので、誤差幅は like + dislike の分散
+    # （Var(like) + Var(dislike) + 2Cov）から求める
+    flagged = like_counts + dislike_counts
+    sums = {
+        "like": (by_cell(like_counts), by_cell(like_counts ** 2)),
+        "dislike": (by_cell(dislike_counts), by_cell(dislike_counts ** 2)),
+        "none": (by_cell(flagged), by_cell(flagged ** 2)),
+    }
+
+    est = sample_df.copy()
+    for kind, (s1, s2) in sums.items():
+        total, variance = stratified_totals(s1, s2, n_h, stratum_sizes)
+        total, variance = total[:len(est)], variance[:len(est)]
+        if kind != "none":
+            est[kind] = np.round(total).astype(int)
+            est[f"{kind}_ratio"] = total / total_ids if total_ids else 0.0
+        est[f"{kind}_margin"] = z * np.sqrt(variance) / total_ids if total_ids else 0.0
+    est["none"] = total_ids - est["like"] - est["dislike"]
+    est["total"] = total_ids
+    est["none_ratio"] = est["none"] / total_ids if total_ids else 0.0
+    if "reassigned" in est.columns:
+        est["reassigned"] = (est["reassigned"] * total_ids / max(resp_rows.sum(), 1)).round().astype(int)
+    est.attrs["sample_size"] = int(n_h.sum())
+    return est
+
+def iter_progressive_area_flags(resp_df, polygons, apply_rule=True, tolerance=None, multi=False,
+                                batch_size=None, segments=None, sample_sizes=PROGRESSIVE_SAMPLE_SIZES, seed=0):
+    # サンプルを大きくしながら概算を yield し、最後に iter_area_flags の正確な結果で置き換える
+    # 概算の area_df には attrs["sample_size"] が付き、coord_df はサンプル分の座標
+    total_ids = len(resp_df)
+    area_set = as_area_set(polygons)
+    rid_codes, _ = get_respondent_codes(resp_df)
+    rng = np.random.default_rng(seed)
+    estimate = None
+    for size in sample_sizes:
+        rows, chosen, chosen_strata, stratum_sizes = draw_sample_rows(rid_codes, size, rng, segments)
+        if len(chosen) >= stratum_sizes.sum():
+            break
+        sample = take_touch_rows(resp_df, rows)
+        sample_df, sample_coords = calculate_area_flags(sample, area_set, apply_rule, tolerance, multi)
+
+        # サンプル内の回答者番号ごとの層と行数
+        sample_codes, _ = get_respondent_codes(sample)
+        first = np.unique(sample_codes, return_index=True)[1]
+        stratum_of = np.zeros(int(stratum_sizes.sum()), dtype=np.int64)
+        stratum_of[chosen] = chosen_strata
+        resp_strata = stratum_of[rid_codes[rows][first]]
+        resp_rows = np.bincount(sample_codes).astype(float)
+
+        counts = respondent_area_counts(sample, area_set, apply_rule, tolerance, multi)
+        estimate = (estimate_area_flags(sample_df, counts, resp_strata, resp_rows, stratum_sizes, total_ids),
+                    sample_coords)
+        yield 0.0, estimate
+
+    for progress, result in iter_area_flags(resp_df, area_set, apply_rule, tolerance, multi, batch_size):
+        if progress < 1 and estimate is not None:
+            yield progress, estimate
+        else:
+            yield progress, result
 
-    coord_df = pd.DataFrame(coord_rows)
+# -----------------------------
+# 🧪 エリアレイアウトの比較（同じ回答データで複数の area.csv を評価）
+# -----------------------------
+def compare_area_layouts(resp_df, layouts, apply_rule=True, tolerance=None, multi=False, max_workers=None):
+    # layouts は {レイアウト名: polygons または AreaSet}。回答データの配列化は一度だけで、
+    # レイアウトごとの判定・集計はスレッドで並列に行う（shapely の判定は GIL を解放する）
+    touches = to_touch_store(resp_df)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {name: pool.submit(calculate_area_flags, touches, areas, apply_rule, tolerance, multi)
+                   for name, areas in layouts.items()}
+        results = {name: future.result()[0] for name, future in futures.items()}
+    return layout_comparison_table(results), results
+
+def layout_comparison_table(results):
+    # エリア × (レイアウト, like_ratio / dislike_ratio) の比較表（レイアウトに無いエリアは NaN）
+    return pd.concat(
+        {name: area_df.set_index("area")[["like_ratio", "dislike_ratio"]] for name, area_df in results.items()},
+        axis=1)
 
-    return area_df, coord_df
+# -----------------------------
+# 📊 複数調査（ウェーブ・市場）の比較
+# -----------------------------
+TOUCH_FILE_COLUMNS = {"Respondent ID"} | {f"{kind}{i}_{axis}" for kind, i in TOUCH_COLUMNS for axis in ("x", "y")}
+
+def read_touch_file(resp_file, transforms=None):
+    # 座標と回答者IDの列（変換表があればそのキー列も）を一度に読み、配列にしたら DataFrame は手放す
+    # 変換表があれば正規化した TouchStore と、変換表に無かった行数を返す
+    columns = TOUCH_FILE_COLUMNS if transforms is None else TOUCH_FILE_COLUMNS | {transforms.columns[0]}
+    touch_df = pd.read_csv(resp_file, usecols=lambda col: col in columns)
+    if transforms is None:
+        return to_touch_store(touch_df), 0
+    return normalize_touches(touch_df, mapping_row_keys(touch_df, transforms.columns[0]), transforms)
+
+def compare_surveys(resp_files, polygons, apply_rule=True, tolerance=None, multi=False, max_workers=None,
+                    transforms=None):
+    # resp_files は {調査名: response.csv}（並び順をウェーブの順とみなす）
+    # 読み込み・正規化・集計は調査ごとにスレッドで並列に行い、エリア定義と空間インデックスは全調査で共有する
+    # 変換表に無かった行数は survey_df.attrs["unmatched"]（{調査名: 行数}）に入れる
+    area_set = as_area_set(polygons)
+    areas = area_set.names
+
+    def summarize(name, resp_file):
+        try:
+            touches, unmatched = read_touch_file(resp_file, transforms)
+        except ValueError as e:
+            raise ValueError(f"{name}: {e}") from e
+        return calculate_area_flags(touches, area_set, apply_rule, tolerance, multi)[0], len(touches), unmatched
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = dict(zip(resp_files, pool.map(summarize, resp_files, resp_files.values())))
+
+    # 調査ごとの集計（survey 列つきで縦に連結）
+    survey_df = pd.concat({name: area_df for name, (area_df, _, _) in results.items()}, names=["survey", None])
+    survey_df = survey_df.reset_index(level="survey").reset_index(drop=True)
+    survey_df.attrs["unmatched"] = {name: unmatched for name, (_, _, unmatched) in results.items()}
+
+    # 全調査をまとめた集計（回答者は調査ごとに別人として合算）
+    sums = survey_df.groupby("area", sort=False).sum(numeric_only=True).reindex(areas)
+    pooled_df = summarize_area_flags(areas, sums["like"].to_numpy(), sums["dislike"].to_numpy(),
+                                     sum(n for _, n, _ in results.values()),
+                                     sums["reassigned"].to_numpy() if tolerance else None)
+
+    # 前のウェーブからの比率の増減
+    deltas = {}
+    names = list(results)
+    for prev, cur in zip(names, names[1:]):
+        prev_df = results[prev][0].set_index("area")
+        cur_df = results[cur][0].set_index("area")
+        for kind in ("like", "dislike"):
+            deltas[(f"{prev} → {cur}", f"{kind}_ratio_diff")] = cur_df[f"{kind}_ratio"] - prev_df[f"{kind}_ratio"]
+    delta_df = pd.DataFrame(deltas, index=pd.Index(areas, name="area"))
+
+    return survey_df, pooled_df, delta_df
 
 # -----------------------------
 # 🎯 相殺前の座標抽出関数
 # -----------------------------
 def extract_all_touch_coords(resp_df):
-    rows = []
-    for idx, row in resp_df.iterrows():
-        rid = row.get("Respondent ID", idx)
-        row_dict = {"Respondent ID": rid}
-        for i in range(1, 3):
-            row_dict[f"like{i}_x"] = row.get(f"like{i}_x")
-            row_dict[f"like{i}_y"] = row.get(f"like{i}_y")
-            row_dict[f"dislike{i}_x"] = row.get(f"dislike{i}_x")
-            row_dict[f"dislike{i}_y"] = row.get(f"dislike{i}_y")
-        rows.append(row_dict)
-    return pd.DataFrame(rows)
+    xs, ys = get_touch_matrix(resp_df)
+    coord_df = pd.DataFrame({"Respondent ID": get_respondent_ids(resp_df)})
+    for c, (kind, i) in enumerate(TOUCH_COLUMNS):
+        coord_df[f"{kind}{i}_x"] = xs[:, c]
+        coord_df[f"{kind}{i}_y"] = ys[:, c]
+    return coord_df
 
 # -----------------------------
 # 🖼️ 座標を画像に描画
 # -----------------------------
-def draw_points_on_image(img, df, color_like=(255, 0, 0), color_dislike=(0, 0, 255), radius=10):
+def iter_draw_points(img, df, color_like=(255, 0, 0), color_dislike=(0, 0, 255), radius=10, batch_size=None):
+    # batch_size タッチずつ描画し、(進捗, 描画中の img) を yield する（コピーは表示する側が必要なときだけ取る）
+    # df は coord_df / resp_df / TouchStore のいずれでもよい（描画順は従来どおり行ごと）
     draw = ImageDraw.Draw(img)
-    for _, row in df.iterrows():
-        for i in range(1, 3):
-            lx = row.get(f"like{i}_x")
-            ly = row.get(f"like{i}_y")
-            dx = row.get(f"dislike{i}_x")
-            dy = row.get(f"dislike{i}_y")
-
-            if pd.notna(lx) and pd.notna(ly):
-                draw.ellipse((lx - radius, ly - radius, lx + radius, ly + radius), fill=color_like)
-            if pd.notna(dx) and pd.notna(dy):
-                draw.ellipse((dx - radius, dy - radius, dx + radius, dy + radius), fill=color_dislike)
+    xs, ys = get_touch_matrix(df)
+    is_like = np.isin(np.arange(len(TOUCH_COLUMNS)), LIKE_COLS)
+    rows, cols = np.nonzero(~(np.isnan(xs) | np.isnan(ys)))
+    n_touches = len(rows)
+    batch_size = batch_size or max(n_touches, 1)
+
+    for start in range(0, n_touches, batch_size):
+        r, c = rows[start:start + batch_size], cols[start:start + batch_size]
+        for x, y, like in zip(xs[r, c].tolist(), ys[r, c].tolist(), is_like[c].tolist()):
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color_like if like else color_dislike)
+        if start + batch_size < n_touches:
+            yield (start + batch_size) / n_touches, img
+    yield 1.0, img
+
+def draw_points_on_image(img, df, color_like=(255, 0, 0), color_dislike=(0, 0, 255), radius=10):
+    for _, img in iter_draw_points(img, df, color_like, color_dislike, radius):
+        pass
     return img
 
+# -----------------------------
+# ⏳ バックグラウンド実行（進捗・途中結果・中断）
+# -----------------------------
+PROGRESS_BATCH_ROWS = 50_000
+PROGRESS_BATCH_TOUCHES = 20_000
+
+def run_in_background(stage, on_update, poll_interval=0.1):
+    # stage は (進捗, 途中結果) を yield するジェネレータで、別スレッドで最後まで回して最終結果を返す
+    # on_update（st の呼び出し）の中で入力変更による再実行が割り込むと、ワーカーも次のバッチで止まる
+    cancel = threading.Event()
+    state = {"latest": None, "error": None, "done": False}
+
+    def worker():
+        try:
+            for update in stage:
+                state["latest"] = update
+                if cancel.is_set():
+                    break
+        except Exception as e:
+            state["error"] = e
+        finally:
+            stage.close()
+            state["done"] = True
+
+    threading.Thread(target=worker, daemon=True).start()
+    shown = None
+    try:
+        while True:
+            done = state["done"]
+            latest = state["latest"]
+            if latest is not None and latest is not shown:
+                on_update(*latest)
+                shown = latest
+            if done:
+                break
+            time.sleep(poll_interval)
+    finally:
+        cancel.set()
+
+    if state["error"] is not None:
+        raise state["error"]
+    return state["latest"][1]
+
+def table_progress(label):
+    # 集計の進捗バーと途中経過の表
+    bar = st.progress(0.0, text=label)
+    table = st.empty()
+
+    def update(progress, result):
+        table.dataframe(result[0])
+        if progress < 1:
+            bar.progress(progress, text=f"{label}（{progress:.0%}・途中経過）")
+        else:
+            bar.empty()
+    return update
+
+def image_progress(label, caption):
+    # 描画の進捗バーと途中経過の画像
+    bar = st.progress(0.0, text=label)
+    picture = st.empty()
+
+    def update(progress, img):
+        # 描画中はワーカーが書き込んでいるので、表示するときだけその時点のコピーを取る
+        picture.image(img.copy() if progress < 1 else img, caption=caption, use_container_width=True)
+        if progress < 1:
+            bar.progress(progress, text=f"{label}（{progress:.0%}）")
+        else:
+            bar.empty()
+    return update
+
+def progressive_progress(label):
+    # 概算の表とサンプルの散布図を、正確な集計が終わるまで順に差し替える
+    bar = st.progress(0.0, text=label)
+    note = st.empty()
+    table = st.empty()
+    chart = st.empty()
+
+    def update(progress, result):
+        area_df, coord_df = result
+        table.dataframe(area_df)
+        if progress >= 1:
+            bar.empty()
+            note.empty()
+            chart.empty()
+            return
+        bar.progress(progress, text=f"{label}（{progress:.0%}）")
+        n_sample = area_df.attrs.get("sample_size")
+        if n_sample is None:
+            return
+        note.caption(f"サンプル {n_sample:,} 人からの概算です（*_margin は割合の約95%誤差幅）。正確な集計に置き換わります。")
+        xs, ys = get_touch_matrix(coord_df)
+        fig, ax = plt.subplots()
+        ax.scatter(xs[:, LIKE_COLS].ravel(), ys[:, LIKE_COLS].ravel(), s=4, c="red", label="like")
+        ax.scatter(xs[:, DISLIKE_COLS].ravel(), ys[:, DISLIKE_COLS].ravel(), s=4, c="blue", label="dislike")
+        ax.invert_yaxis()
+        ax.legend()
+        ax.set_title(f"Sampled touches (n={n_sample:,})")
+        chart.pyplot(fig)
+        plt.close(fig)
+    return update
+
+# -----------------------------
+# 📤 エクスポート（CSV / Parquet / XLSX / PNG / ZIP）
+# -----------------------------
+EXPORT_CHUNK_ROWS = 100_000
+PREVIEW_PAGE_ROWS = 1_000
+
+def write_csv(df, file):
+    # 行をチャンクごとに CSV にして書き出す（表全体の文字列を一度に作らない）
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    for start in range(0, max(len(df), 1), EXPORT_CHUNK_ROWS):
+        df.iloc[start:start + EXPORT_CHUNK_ROWS].to_csv(text, index=False, header=start == 0)
+    text.flush()
+    text.detach()
+
+def write_parquet(df, file):
+    # チャンクごとに row group として書き出す
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(file, schema) as writer:
+        for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+            chunk = df.iloc[start:start + EXPORT_CHUNK_ROWS]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+def write_xlsx(tables, file):
+    # 集計表（小さい表）を 1 ファイルのシートにまとめる
+    with pd.ExcelWriter(file, engine="openpyxl") as writer:
+        for name, df in tables.items():
+            df.to_excel(writer, sheet_name=name[:31], index=False)
+
+def write_png(img, file):
+    img.save(file, format="PNG")
+
+def export_formats():
+    # 表ごとの出力形式（Parquet は pyarrow があるときだけ。XLSX は集計表をまとめて別に出す）
+    formats = {"CSV": (write_csv, "csv", "text/csv")}
+    if importlib.util.find_spec("pyarrow"):
+        formats["Parquet"] = (write_parquet, "parquet", "application/vnd.apache.parquet")
+    return formats
+
+def write_export_zip(bundle, file):
+    # bundle は {"tables": 集計表, "coords": 座標の表, "images": 画像}。各ファイルを ZIP の中へ直接書き出す
+    tables, coords, images = bundle.get("tables", {}), bundle.get("coords", {}), bundle.get("images", {})
+    with zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, df in {**tables, **coords}.items():
+            for write, ext, _ in export_formats().values():
+                with zf.open(f"{name}.{ext}", "w", force_zip64=True) as f:
+                    write(df, f)
+        if tables and importlib.util.find_spec("openpyxl"):
+            with zf.open("summary.xlsx", "w", force_zip64=True) as f:
+                write_xlsx(tables, f)
+        for name, img in images.items():
+            with zf.open(f"{name}.png", "w", force_zip64=True) as f:
+                write_png(img, f)
+
+def export_file(write, obj):
+    # ディスク上の一時ファイルに書き出し、先頭から読めるようにして返す
+    file = tempfile.TemporaryFile()
+    write(obj, file)
+    file.seek(0)
+    return file
+
+def show_export_buttons(tables, coords, images):
+    # ダウンロード時にだけ書き出す（data に関数を渡すとクリックされたときに別スレッドで実行される）
+    for name, df in {**tables, **coords}.items():
+        formats = export_formats()
+        for col, (label, (write, ext, mime)) in zip(st.columns(len(formats)), formats.items()):
+            col.download_button(f"{name}（{label}）", partial(export_file, write, df),
+                                file_name=f"{name}.{ext}", mime=mime)
+    if tables and importlib.util.find_spec("openpyxl"):
+        st.download_button("集計表（XLSX）", partial(export_file, write_xlsx, tables), file_name="summary.xlsx",
+                           mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    for name, img in images.items():
+        st.download_button(f"{name}（PNG・原寸）", partial(export_file, write_png, img),
+                           file_name=f"{name}.png", mime="image/png")
+    bundle = {"tables": tables, "coords": coords, "images": images}
+    st.download_button("すべてまとめて（ZIP）", partial(export_file, write_export_zip, bundle),
+                       file_name="export.zip", mime="application/zip")
+
+def show_paginated(df, key, page_rows=PREVIEW_PAGE_ROWS):
+    # 大きな表はページ単位のプレビューだけをブラウザに送る
+    n_pages = max((len(df) + page_rows - 1) // page_rows, 1)
+    page = st.number_input(f"ページ（全 {n_pages:,} ページ）", min_value=1, max_value=n_pages, value=1, key=key)
+    start = (page - 1) * page_rows
+    st.dataframe(df.iloc[start:start + page_rows])
+    st.caption(f"全 {len(df):,} 行中 {min(start + 1, len(df)):,}〜{min(start + page_rows, len(df)):,} 行目")
+
+def unique_upload_names(files):
+    # 同じ名前のファイルが複数アップロードされても上書きされないよう、2 つ目以降にアップロード順の番号を付ける
+    uploads = {}
+    for i, f in enumerate(files, start=1):
+        name = f.name
+        while name in uploads:
+            name = f"{name} ({i})"
+        uploads[name] = f
+    return uploads
+
+def normalize_upload(resp_file, mapping_file, resp_df):
+    # アップロードされた変換表で座標を正規化し、変換表に無い行があれば知らせる
+    # 変換表は調査ごとに何度も読むので、読み込み位置に依らない getvalue() から読む
+    try:
+        *arrays, unmatched = normalized_touches(resp_file.file_id, mapping_file.file_id, resp_df,
+                                                pd.read_csv(io.BytesIO(mapping_file.getvalue())), resp_file)
+    except ValueError as e:
+        st.error(f"{resp_file.name}: {e}")
+        st.stop()
+    if unmatched:
+        st.warning(f"{resp_file.name}: 変換表に無い {unmatched:,} 行は座標をそのまま使います")
+    return TouchStore(*arrays), unmatched
+
 # -----------------------------
 # 🖥️ Streamlit アプリ本体
 # -----------------------------
 st.title("画像エリアの好き嫌い集計・可視化ツール")
 
-mode = st.radio("処理を選択してください", ["データ集計", "画像へのプロット"])
+mode = st.radio("処理を選択してください", ["データ集計", "画像へのプロット", "レイアウト比較", "複数調査の比較"])
 
 if mode == "データ集計":
     st.header("データアップロード")
-    area_file = st.file_uploader("エリア定義CSV（area.csv）", type="csv")
+    area_file = st.file_uploader("エリア定義（area.csv またはコンパイル済み .npz）", type=["csv", "npz"])
     resp_file = st.file_uploader("回答データCSV（response.csv）", type="csv")
 
-    if area_file and resp_file:
-        area_df = pd.read_csv(area_file)
-        resp_df = pd.read_csv(resp_file)
+    use_store = st.checkbox("回答データをバイナリストアに取り込んで再利用する（大規模データ向け）")
+
+    mapping_file = st.file_uploader("端末座標→画像座標の変換表（任意・1列目は端末の列名または Respondent ID）", type="csv")
 
-        polygons = {}
-        for name, group in area_df.groupby("name"):
-            points = [(x, y) for x, y in zip(group["x"], group["y"])]
-            polygons[name] = Polygon(points)
+    if area_file and resp_file:
+        resp_df = touch_store_for_upload(resp_file) if use_store else pd.read_csv(resp_file)
+        raw_df = resp_df
+        if mapping_file:
+            resp_df, _ = normalize_upload(resp_file, mapping_file, raw_df)
+
+        polygons = read_area_file(area_file)
+        if not area_file.name.endswith(".npz"):
+            artifact = io.BytesIO()
+            save_area_set(polygons, artifact)
+            st.download_button("コンパイル済みエリア定義（.npz）をダウンロード", artifact.getvalue(),
+                               file_name="area.npz", mime="application/octet-stream")
+        for issue in polygons.issues:
+            st.warning(issue)
+
+        use_tolerance = st.checkbox("エリア外のタッチを最寄りエリアに割り当てる（許容距離モード）")
+        tolerance = None
+        if use_tolerance:
+            tolerance = st.number_input("許容距離（px）", min_value=0.0, value=10.0, step=1.0)
+        multi = st.checkbox("重なっているエリアにはすべてカウントする（複数所属モード）")
+
+        progressive = st.checkbox("サンプルで先に概算を表示する（プログレッシブ表示）")
+        stage, view = iter_area_flags, table_progress
+        if progressive:
+            segment_col = None
+            if isinstance(raw_df, pd.DataFrame):
+                segment_col = st.selectbox("層別抽出に使うセグメント列（任意）", [None] + list(raw_df.columns))
+            segments = raw_df[segment_col].to_numpy() if segment_col else None
+            stage, view = partial(iter_progressive_area_flags, segments=segments), progressive_progress
 
         st.subheader("ルール適用前の集計")
-        before_df, _ = calculate_area_flags(resp_df, polygons, apply_rule=False)
-        st.dataframe(before_df)
+        before_df, _ = run_in_background(
+            stage(resp_df, polygons, apply_rule=False, tolerance=tolerance, multi=multi,
+                  batch_size=PROGRESS_BATCH_ROWS),
+            view("ルール適用前を集計中"))
 
         st.subheader("ルール適用後の集計")
-        after_df, coord_df = calculate_area_flags(resp_df, polygons, apply_rule=True)
-        st.dataframe(after_df)
+        after_df, coord_df = run_in_background(
+            stage(resp_df, polygons, apply_rule=True, tolerance=tolerance, multi=multi,
+                  batch_size=PROGRESS_BATCH_ROWS),
+            view("ルール適用後を集計中"))
 
         st.subheader("ルール適用前後の差分")
         diff_df = after_df[["area", "like", "dislike"]].copy()
@@ -196,34 +1020,132 @@ if mode == "データ集計":
         st.pyplot(fig)
 
         st.subheader("有効なタッチ座標一覧（相殺後）")
-        st.dataframe(coord_df)
+        show_paginated(coord_df, key="coord_page")
 
         st.subheader("ルール適用後の座標プロット")
         image_file = st.file_uploader("背景画像（プロット用）", type=["png", "jpg", "jpeg"], key="plot_img1")
+        images = {}
         if image_file:
             image = Image.open(image_file).convert("RGB")
-            plotted_img = draw_points_on_image(image.copy(), coord_df)
-            st.image(plotted_img, caption="ルール適用後のプロット", use_container_width=True)
+            images["plot_after_rule"] = run_in_background(
+                iter_draw_points(image.copy(), coord_df, batch_size=PROGRESS_BATCH_TOUCHES),
+                image_progress("ルール適用後を描画中", "ルール適用後のプロット"))
 
         st.subheader("相殺前の全タッチ座標プロット")
-        all_coords_df = extract_all_touch_coords(resp_df)
         if image_file:
-            full_plot_img = draw_points_on_image(image.copy(), all_coords_df)
-            st.image(full_plot_img, caption="相殺前の全タッチプロット", use_container_width=True)
+            images["plot_all_touches"] = run_in_background(
+                iter_draw_points(image.copy(), resp_df, batch_size=PROGRESS_BATCH_TOUCHES),
+                image_progress("相殺前を描画中", "相殺前の全タッチプロット"))
+
+        st.subheader("エクスポート")
+        show_export_buttons(
+            {"area_before_rule": before_df, "area_after_rule": after_df,
+             "area_diff": diff_df[["area", "like_diff", "dislike_diff"]]},
+            {"coord_after_rule": coord_df},
+            images)
 
 elif mode == "画像へのプロット":
     st.header("画像へのプロット")
     image_file = st.file_uploader("背景画像（.png / .jpg）", type=["png", "jpg", "jpeg"])
     resp_file = st.file_uploader("回答データCSV（response.csv）", type="csv")
 
+    use_store = st.checkbox("回答データをバイナリストアに取り込んで再利用する（大規模データ向け）")
+    mapping_file = st.file_uploader("端末座標→画像座標の変換表（任意・1列目は端末の列名または Respondent ID）", type="csv")
+
     if image_file and resp_file:
-        resp_df = pd.read_csv(resp_file)
-        coord_df = extract_all_touch_coords(resp_df)
+        resp_df = touch_store_for_upload(resp_file) if use_store else pd.read_csv(resp_file)
+        if mapping_file:
+            resp_df, _ = normalize_upload(resp_file, mapping_file, resp_df)
 
         image = Image.open(image_file).convert("RGB")
-        plotted_img = draw_points_on_image(image.copy(), coord_df)
-
-        st.image(plotted_img, caption="全タッチプロット", use_container_width=True)
+        run_in_background(
+            iter_draw_points(image.copy(), resp_df, batch_size=PROGRESS_BATCH_TOUCHES),
+            image_progress("描画中", "全タッチプロット"))
+
+elif mode == "レイアウト比較":
+    st.header("エリアレイアウトの比較")
+    layout_files = st.file_uploader("エリア定義（area.csv または .npz、複数可）", type=["csv", "npz"],
+                                    accept_multiple_files=True)
+    resp_file = st.file_uploader("回答データCSV（response.csv）", type="csv")
+    use_store = st.checkbox("回答データをバイナリストアに取り込んで再利用する（大規模データ向け）")
+    mapping_file = st.file_uploader("端末座標→画像座標の変換表（任意・1列目は端末の列名または Respondent ID）", type="csv")
+    apply_rule = st.checkbox("相殺ルールを適用する", value=True)
+
+    if layout_files and resp_file:
+        # レイアウトごとの集計は (回答データ, 変換表, レイアウトの file_id, apply_rule) ごとにセッションに残し、
+        # レイアウトを追加したときはそのレイアウトの判定だけを行う
+        resp_key = (resp_file.file_id, mapping_file.file_id if mapping_file else None)
+        cache = st.session_state.setdefault("layout_results", {})
+        for key in [key for key in cache if key[0] != resp_key]:
+            del cache[key]
+
+        uploads = unique_upload_names(layout_files)
+        layouts, results = {}, {}
+        for name, layout_file in uploads.items():
+            key = (resp_key, layout_file.file_id, apply_rule)
+            if key in cache:
+                results[name], issues = cache[key]
+            else:
+                layouts[name] = read_area_file(layout_file)
+                issues = layouts[name].issues
+            for issue in issues:
+                st.warning(f"{name} - {issue}")
+
+        if layouts:
+            if use_store:
+                resp_df = touch_store_for_upload(resp_file)
+            else:
+                resp_df = TouchStore(*uploaded_touches(resp_file.file_id, resp_file))
+            if mapping_file:
+                resp_df, _ = normalize_upload(resp_file, mapping_file, resp_df)
+            _, new_results = compare_area_layouts(resp_df, layouts, apply_rule=apply_rule)
+            for name, area_df in new_results.items():
+                cache[(resp_key, uploads[name].file_id, apply_rule)] = (area_df, layouts[name].issues)
+            results.update(new_results)
+
+        results = {name: results[name] for name in uploads}
+        comparison_df = layout_comparison_table(results)
+
+        st.subheader("レイアウト別の like / dislike 比率")
+        st.dataframe(comparison_df)
+
+        for name, area_df in results.items():
+            with st.expander(f"{name} の集計"):
+                st.dataframe(area_df)
+
+elif mode == "複数調査の比較":
+    st.header("複数調査（ウェーブ・市場）の比較")
+    area_file = st.file_uploader("エリア定義（area.csv または .npz）", type=["csv", "npz"])
+    resp_files = st.file_uploader("回答データCSV（複数可・ウェーブ順にアップロード）", type="csv",
+                                  accept_multiple_files=True)
+    mapping_file = st.file_uploader("端末座標→画像座標の変換表（任意・1列目は端末の列名または Respondent ID）", type="csv")
+    apply_rule = st.checkbox("相殺ルールを適用する", value=True)
+
+    if area_file and resp_files:
+        polygons = read_area_file(area_file)
+        for issue in polygons.issues:
+            st.warning(issue)
+
+        transforms = pd.read_csv(mapping_file) if mapping_file else None
+        try:
+            survey_df, pooled_df, delta_df = compare_surveys(unique_upload_names(resp_files), polygons,
+                                                             apply_rule=apply_rule, transforms=transforms)
+        except ValueError as e:
+            st.error(str(e))
+            st.stop()
+        for name, unmatched in survey_df.attrs["unmatched"].items():
+            if unmatched:
+                st.warning(f"{name}: 変換表に無い {unmatched:,} 行は座標をそのまま使います")
+
+        st.subheader("全調査の合算")
+        st.dataframe(pooled_df)
+
+        st.subheader("調査ごとの集計")
+        st.dataframe(survey_df)
+
+        if len(resp_files) > 1:
+            st.subheader("前のウェーブからの比率の増減")
+            st.dataframe(delta_df)
 
 # -
 